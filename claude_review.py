@@ -1,88 +1,253 @@
 # scripts/claude_review.py
+import hashlib
 import os
+import re
+import sqlite3
 import gitlab
 import anthropic
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext
+from string import Template
 
 
-# Standard .claude paths that Claude Code uses
+# Standard CLAUDE.md paths that Claude Code uses; always loaded in full
 CLAUDE_MD_PATHS = [
     "CLAUDE.md",
     ".claude/CLAUDE.md",
-    ".claude/settings.json",
 ]
 
-
-def load_claude_context():
-    """Load CLAUDE.md and .claude/ config files from local filesystem."""
-    context_parts = []
-
+# Files whose diffs are skipped: lockfiles, minified assets and binaries
+# that cost prompt tokens without being meaningfully reviewable. Every
+# "*.lock" file is a lockfile; the set lists the ones without that suffix.
+SKIP_DIFF_FILES = {
+    "package-lock.json",
+    "pnpm-lock.yaml",
+    "go.sum",
+}
+SKIP_DIFF_SUFFIXES = (
+    ".min.js",
+    ".min.css",
+    ".map",
+    ".svg",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".ico",
+    ".pdf",
+)
+
+# Added or removed line with non-whitespace content. Diffs that have none
+# are pure renames, mode changes, binary files or blank-line edits.
+SUBSTANTIVE_LINE_RE = re.compile(r"^[+-][ \t]*\S", re.MULTILINE)
+
+NO_SUBSTANTIVE_CHANGES_NOTE = (
+    "🤖 **Claude Code Review**\n\n"
+    "No substantive changes to review: the diff only contains renames, "
+    "mode changes, blank-line edits or omitted files."
+)
+
+FILE_TRUNCATED_MARKER = "\n\n... (file truncated)"
+CONTEXT_TRUNCATED_MARKER = "\n\n... (context truncated)"
+
+
+def walk_files(directory):
+    """Yield paths of files under directory recursively, in sorted order."""
+    with os.scandir(directory) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+
+    for entry in entries:
+        # DirEntry caches the file type from the directory listing
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk_files(entry.path)
+        elif entry.is_file():
+            yield entry.path
+
+
+def read_text(file_path):
+    # Raw bytes + decode avoids the TextIOWrapper layer of text-mode open
+    with open(file_path, "rb") as f:
+        return f.read().decode("utf-8")
+
+
+def context_priority(rel_path):
+    """Sort key for .claude/ files: settings last, commands just before them."""
+    name = os.path.basename(rel_path)
+    if name.startswith("settings") and name.endswith(".json"):
+        return 2
+    if rel_path.startswith(".claude/commands/"):
+        return 1
+    return 0
+
+
+def load_claude_context(max_file_chars, max_context_chars):
+    """Load CLAUDE.md and .claude/ config files from local filesystem.
+
+    The CLAUDE.md paths are always loaded in full. Other .claude/ files
+    are truncated to max_file_chars each and added in priority order
+    until max_context_chars is reached, so settings files are dropped
+    first, then commands.
+    """
     # Get the project directory from GitLab CI environment
-    project_dir = Path(os.getenv("CI_PROJECT_DIR", "."))
+    project_dir = os.getenv("CI_PROJECT_DIR", ".")
     print(f"Loading context from project directory: {project_dir}")
 
-    # Load standard paths
+    # Plain string paths; entries under it are sliced to relative paths
+    path_prefix = os.path.join(project_dir, "")
+    claude_dir = path_prefix + ".claude"
+    has_claude_dir = os.path.isdir(claude_dir)
+
+    # Collect all files to load first, then read them in one pass
+    files = []
+
+    # Standard paths
     for path in CLAUDE_MD_PATHS:
-        file_path = project_dir / path
-        if file_path.exists() and file_path.is_file():
-            try:
-                content = file_path.read_text(encoding="utf-8")
-                print(f"Added file {path} content to context")
-                context_parts.append(f"--- {path} ---\n{content}")
-            except Exception as e:
-                print(f"Warning: Could not read {path}: {e}")
+        # Skip .claude/ paths when the directory is absent, as in most repos
+        if not has_claude_dir and path.startswith(".claude/"):
+            continue
+        file_path = path_prefix + path
+        if os.path.isfile(file_path):
+            files.append((path, file_path))
+
+    # All other files in .claude/ directory
+    if has_claude_dir:
+        other_files = []
+        for file_path in walk_files(claude_dir):
+            # Get relative path from project directory
+            rel_path = file_path[len(path_prefix) :]
+            # Skip already loaded files
+            if rel_path in CLAUDE_MD_PATHS:
                 continue
+            other_files.append((rel_path, file_path))
+        # Stable sort keeps the walk order within each priority
+        other_files.sort(key=lambda item: context_priority(item[0]))
+        files.extend(other_files)
+
+    if not files:
+        return ""
 
-    # Load all other files in .claude/ directory
-    claude_dir = project_dir / ".claude"
-    if claude_dir.exists() and claude_dir.is_dir():
-        for file_path in claude_dir.rglob("*"):
-            if file_path.is_file():
-                # Get relative path from project directory
-                rel_path = str(file_path.relative_to(project_dir))
-                # Skip already loaded files
-                if rel_path in CLAUDE_MD_PATHS:
-                    continue
-                try:
-                    content = file_path.read_text(encoding="utf-8")
-                    print(f"Added file {rel_path} content to context")
-                    context_parts.append(f"--- {rel_path} ---\n{content}")
-                except Exception as e:
-                    print(f"Warning: Could not read {rel_path}: {e}")
-                    continue
+    # Read files concurrently; the GIL is released during read(2), so
+    # cold-cache reads overlap. Results are kept in the original order.
+    max_workers = min(len(files), (os.cpu_count() or 1) * 2)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(read_text, file_path) for _, file_path in files]
+
+    context_parts = []
+    total_chars = 0
+    for (rel_path, _), future in zip(files, futures):
+        try:
+            content = future.result()
+        except Exception as e:
+            print(f"Warning: Could not read {rel_path}: {e}")
+            continue
+
+        header = f"--- {rel_path} ---\n"
+        # Account for the "\n\n" separator between parts
+        separator_chars = 2 if context_parts else 0
+
+        if rel_path not in CLAUDE_MD_PATHS:
+            remaining = max_context_chars - total_chars - separator_chars - len(header)
+            if remaining <= 0:
+                print(f"Warning: Skipped {rel_path}: context limit reached")
+                continue
+
+            if len(content) > max_file_chars or len(content) > remaining:
+                # Slice once and add a single marker that fits within the budget
+                if max_file_chars + len(FILE_TRUNCATED_MARKER) <= remaining:
+                    print(f"Warning: Truncated {rel_path} to {max_file_chars} chars")
+                    marker, limit = FILE_TRUNCATED_MARKER, max_file_chars
+                else:
+                    marker = CONTEXT_TRUNCATED_MARKER
+                    limit = min(max_file_chars, remaining - len(marker))
+                    if limit <= 0:
+                        print(f"Warning: Skipped {rel_path}: context limit reached")
+                        continue
+                    print(f"Warning: Truncated {rel_path}: context limit reached")
+                content = content[:limit] + marker
+
+        print(f"Added file {rel_path} content to context")
+        context_parts.append(header + content)
+        total_chars += separator_chars + len(header) + len(content)
 
     return "\n\n".join(context_parts)
 
 
-def get_mr_diff(project, mr_iid):
+def skip_diff_reason(change):
+    """Return why a file's diff should be left out of the review, or None."""
+    path = change["new_path"].lower()
+    if change.get("generated_file"):
+        return "generated file"
+    if path.endswith(".lock") or os.path.basename(path) in SKIP_DIFF_FILES:
+        return "lockfile"
+    if path.endswith(SKIP_DIFF_SUFFIXES):
+        return "generated or binary file"
+    return None
+
+
+def get_mr_diff(project, mr_iid, max_file_diff_chars):
     mr = project.mergerequests.get(mr_iid)
     changes = mr.changes()["changes"]
 
     diff_parts = []
+    substantive = False
     for c in changes:
-        diff_parts.append(f"--- {c['old_path']}\n+++ {c['new_path']}\n{c['diff']}")
-
-    return mr, "\n".join(diff_parts)
-
-
-def build_prompt(mr, diff_text, claude_context):
-    context_block = ""
-    if claude_context:
-        context_block = f"""
+        header = f"--- {c['old_path']}\n+++ {c['new_path']}"
+        reason = skip_diff_reason(c)
+        if reason:
+            # Keep the file header so the reviewer still sees it changed
+            print(f"Skipped diff for {c['new_path']}: {reason}")
+            diff_parts.append(f"{header}\n(diff omitted: {reason})\n")
+            continue
+
+        diff = c["diff"]
+        if len(diff) > max_file_diff_chars:
+            # Keep the start of oversized code diffs rather than dropping them
+            print(f"Truncated diff for {c['new_path']} to {max_file_diff_chars} chars")
+            diff = diff[:max_file_diff_chars] + "\n... (file diff truncated)\n"
+        diff_parts.append(f"{header}\n{diff}")
+        # Check the full diff, so a truncated large file still counts
+        if not substantive and SUBSTANTIVE_LINE_RE.search(c["diff"]):
+            substantive = True
+
+    return mr, diff_parts, substantive
+
+
+def join_diff(diff_parts, max_chars):
+    """Join per-file diffs, truncating at max_chars without copying the full diff."""
+    kept = []
+    total = 0
+    for part in diff_parts:
+        # Account for the newline separator between parts
+        remaining = max_chars - total - (1 if kept else 0)
+        if len(part) > remaining:
+            if remaining >= 0:
+                kept.append(part[:remaining])
+            return "\n".join(kept) + "\n\n... (diff truncated)"
+        total += len(part) + (1 if kept else 0)
+        kept.append(part)
+
+    return "\n".join(kept)
+
+
+PROJECT_RULES_HEADER = """
 ## Project-Specific Rules
 
 The following are the project's CLAUDE.md and .claude/ configuration files.
 These contain project rules, conventions, and instructions you MUST follow when reviewing:
 
-{claude_context}
+"""
+
+PROJECT_RULES_FOOTER = """
 
 --- End of project rules ---
 
 """
 
-    system_content = f"""You are a senior software engineer conducting a code review of a merge request. Focus your review on the actual changes in the diff — do not comment on unchanged code or hypothetical issues outside the scope of the MR.
+# Compiled once at import; build_prompt() only substitutes the
+# per-MR values into the static review rubric
+REVIEW_SYSTEM_TEMPLATE = Template("""You are a senior software engineer conducting a code review of a merge request. Focus your review on the actual changes in the diff — do not comment on unchanged code or hypothetical issues outside the scope of the MR.
 
-{context_block}## What to Look For
+${project_rules}## What to Look For
 
 Focus on issues that **actually appear in the diff**. Prioritize by impact:
 
@@ -130,58 +295,45 @@ Structure your review with these sections. **Omit any section that has no items*
 **Verdict**: One of the following:
 - **APPROVE** — Changes are correct and ready to merge (may have minor nits)
 - **APPROVE WITH SUGGESTIONS** — No blocking issues, but suggestions would improve the code
-- **REQUEST CHANGES** — Use this if and only if the Critical Issues section is non-empty"""
+- **REQUEST CHANGES** — Use this if and only if the Critical Issues section is non-empty""")
 
-    user_content = f"""## Merge Request Details
+MR_DETAILS_TEMPLATE = Template("""## Merge Request Details
 
-**Title**: {mr.title}
-**Description**: {mr.description or "N/A"}
+**Title**: ${title}
+**Description**: ${description}
 
 ## Code Changes
 
-{diff_text}"""
-
-    return system_content, user_content
-
+${diff}""")
 
-def main():
-    gitlab_url = os.environ["CI_SERVER_URL"]
-    project_id = os.environ["CI_PROJECT_ID"]
-    mr_iid = os.environ["CI_MERGE_REQUEST_IID"]
-    # Try GITLAB_TOKEN first, fallback to CI_JOB_TOKEN
-    gitlab_token = os.getenv("GITLAB_TOKEN") or os.environ["CI_JOB_TOKEN"]
 
-    gl = gitlab.Gitlab(gitlab_url, private_token=gitlab_token)
-    project = gl.projects.get(project_id)
-
-    # Load .claude/ context from local filesystem
-    claude_context = load_claude_context()
+def build_prompt(mr, diff_text, claude_context):
+    project_rules = ""
     if claude_context:
-        print(f"Loaded .claude/ context ({len(claude_context)} chars)")
-    else:
-        print("No .claude/ config found, reviewing without project rules")
-
-    mr, diff_text = get_mr_diff(project, mr_iid)
+        project_rules = "".join(
+            (PROJECT_RULES_HEADER, claude_context, PROJECT_RULES_FOOTER)
+        )
 
-    if not diff_text.strip():
-        print("No changes to review")
-        return
+    system_content = REVIEW_SYSTEM_TEMPLATE.substitute(project_rules=project_rules)
+    user_content = MR_DETAILS_TEMPLATE.substitute(
+        title=mr.title,
+        description=mr.description or "N/A",
+        diff=diff_text,
+    )
 
-    max_chars = int(os.getenv("MAX_DIFF_CHARS", "100000"))
-    if len(diff_text) > max_chars:
-        diff_text = diff_text[:max_chars] + "\n\n... (diff truncated)"
+    return system_content, user_content
 
-    system_content, user_content = build_prompt(mr, diff_text, claude_context)
 
+def request_review(model, max_tokens, system_content, user_content):
+    """Ask Claude for a review; return (review, token_summary, truncated)."""
     # Initialize Anthropic client with API key from environment
     api_key = os.environ["ANTHROPIC_API_KEY"]
     client = anthropic.Anthropic(api_key=api_key)
-    model = os.getenv("ANTHROPIC_REVIEW_MODEL", "claude-sonnet-4-6")
 
-    print(f"Model used for review: {model}")
-
-    max_tokens = int(os.getenv("ANTHROPIC_MAX_OUTPUT_TOKENS", "16000"))
-    msg = client.messages.create(
+    # Stream the response so long reviews are not subject to the SDK's
+    # non-streaming request timeout and tokens are consumed as they arrive
+    review_chunks = []
+    with client.messages.stream(
         model=model,
         max_tokens=max_tokens,
         system=[
@@ -192,7 +344,10 @@ def main():
             }
         ],
         messages=[{"role": "user", "content": user_content}],
-    )
+    ) as stream:
+        for text in stream.text_stream:
+            review_chunks.append(text)
+        msg = stream.get_final_message()
 
     usage = msg.usage
     print(f"Tokens - input: {usage.input_tokens}, output: {usage.output_tokens}")
@@ -213,14 +368,135 @@ def main():
         token_parts.append(f"cache read: {cache_read}")
     token_summary = ", ".join(token_parts)
 
-    if msg.stop_reason == "max_tokens":
+    truncated = msg.stop_reason == "max_tokens"
+    if truncated:
         print(
             f"WARNING: response truncated at max_tokens={max_tokens}; "
             "review may be incomplete. Increase ANTHROPIC_MAX_OUTPUT_TOKENS."
         )
 
-    review = "".join(block.text for block in msg.content if block.type == "text")
-    footer = f"\n\n---\n_Model: `{model}` · Tokens — {token_summary}_"
+    review = "".join(review_chunks)
+    return review, token_summary, truncated
+
+
+def review_cache_key(model, max_tokens, system_content, user_content):
+    """Hash everything that determines the review into a cache key."""
+    h = hashlib.blake2b(digest_size=16)
+    for part in (model, str(max_tokens), system_content, user_content):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def open_review_cache(path):
+    """Open the review cache, or return None so the review runs without it."""
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = sqlite3.connect(path)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Warning: Could not open review cache {path}: {e}")
+        return None
+
+    try:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS reviews "
+            "(key TEXT PRIMARY KEY, review TEXT NOT NULL)"
+        )
+    except sqlite3.Error as e:
+        conn.close()
+        print(f"Warning: Could not open review cache {path}: {e}")
+        return None
+    return conn
+
+
+def get_cached_review(conn, key):
+    try:
+        row = conn.execute(
+            "SELECT review FROM reviews WHERE key = ?", (key,)
+        ).fetchone()
+    except sqlite3.Error as e:
+        print(f"Warning: Could not read review cache: {e}")
+        return None
+    return row[0] if row else None
+
+
+def store_cached_review(conn, key, review):
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO reviews (key, review) VALUES (?, ?)",
+                (key, review),
+            )
+    except sqlite3.Error as e:
+        print(f"Warning: Could not write review cache: {e}")
+
+
+def main():
+    gitlab_url = os.environ["CI_SERVER_URL"]
+    project_id = os.environ["CI_PROJECT_ID"]
+    mr_iid = os.environ["CI_MERGE_REQUEST_IID"]
+    # Try GITLAB_TOKEN first, fallback to CI_JOB_TOKEN
+    gitlab_token = os.getenv("GITLAB_TOKEN") or os.environ["CI_JOB_TOKEN"]
+
+    gl = gitlab.Gitlab(gitlab_url, private_token=gitlab_token)
+    # Lazy: only the project ID is needed to build MR URLs, so skip the
+    # GET /projects/:id round trip
+    project = gl.projects.get(project_id, lazy=True)
+
+    max_file_chars = int(os.getenv("MAX_CONTEXT_FILE_CHARS", "25000"))
+    max_context_chars = int(os.getenv("MAX_CONTEXT_CHARS", "100000"))
+    max_chars = int(os.getenv("MAX_DIFF_CHARS", "100000"))
+    max_file_diff_chars = int(os.getenv("MAX_FILE_DIFF_CHARS", str(max_chars)))
+
+    # Load .claude/ context from local filesystem
+    claude_context = load_claude_context(max_file_chars, max_context_chars)
+    if claude_context:
+        print(f"Loaded .claude/ context ({len(claude_context)} chars)")
+    else:
+        print("No .claude/ config found, reviewing without project rules")
+
+    mr, diff_parts, substantive = get_mr_diff(project, mr_iid, max_file_diff_chars)
+
+    if not diff_parts:
+        print("No changes to review")
+        return
+
+    if not substantive:
+        mr.notes.create({"body": NO_SUBSTANTIVE_CHANGES_NOTE})
+        print("No substantive changes, skipped review")
+        return
+
+    diff_text = join_diff(diff_parts, max_chars)
+
+    system_content, user_content = build_prompt(mr, diff_text, claude_context)
+
+    model = os.getenv("ANTHROPIC_REVIEW_MODEL", "claude-sonnet-4-6")
+    max_tokens = int(os.getenv("ANTHROPIC_MAX_OUTPUT_TOKENS", "16000"))
+
+    print(f"Model used for review: {model}")
+
+    # Optional review cache, persisted between pipelines via GitLab CI cache
+    cache_path = os.getenv("REVIEW_CACHE_DB")
+    cache = open_review_cache(cache_path) if cache_path else None
+    with closing(cache) if cache is not None else nullcontext():
+        review = None
+        if cache is not None:
+            cache_key = review_cache_key(
+                model, max_tokens, system_content, user_content
+            )
+            review = get_cached_review(cache, cache_key)
+
+        if review is not None:
+            print("Found cached review for identical prompt, skipping Claude call")
+            footer = f"\n\n---\n_Model: `{model}` · Cached review, no tokens used_"
+        else:
+            review, token_summary, truncated = request_review(
+                model, max_tokens, system_content, user_content
+            )
+            if cache is not None and not truncated:
+                store_cached_review(cache, cache_key, review)
+            footer = f"\n\n---\n_Model: `{model}` · Tokens — {token_summary}_"
+
     mr.notes.create({"body": f"🤖 **Claude Code Review**\n\n{review}{footer}"})
     print("Review posted successfully.")
 